@@ -61,7 +61,12 @@ from ..from_source import verify_upstream_command  # noqa: E402
 from ..from_source.verify import LENIENT_FILE_ERROR_IGNORES, FileError  # noqa: E402
 from ..new_ansible import new_ansible_command  # noqa: E402
 from ..sanity_tests import sanity_tests_command  # noqa: E402
-from ..tagging import validate_tags_command, validate_tags_file_command  # noqa: E402
+from ..tagging import (  # noqa: E402
+    DEFAULT_MIRROR_REFRESH_TTL,
+    DEFAULT_TAG_CACHE_TTL,
+    validate_tags_command,
+    validate_tags_file_command,
+)
 
 # pylint: enable=wrong-import-position
 
@@ -629,6 +634,37 @@ def parse_args(program_name: str, args: list[str]) -> argparse.Namespace:
         help="Path to output a collection tag data file."
         " If this is ommited, no tag data will be written",
     )
+    validate_tags.add_argument(
+        "--mirror-dir",
+        default=None,
+        help="Directory in which to keep bare clones of the collections'"
+        " repositories. If this is specified, tags are read from these"
+        " local mirrors instead of being queried with git ls-remote.",
+    )
+    validate_tags.add_argument(
+        "--mirror-refresh-ttl",
+        type=int,
+        default=DEFAULT_MIRROR_REFRESH_TTL,
+        help="Number of seconds after which an existing mirror in"
+        " --mirror-dir is fetched again."
+        f" The default is {DEFAULT_MIRROR_REFRESH_TTL}.",
+    )
+    validate_tags.add_argument(
+        "--tag-cache",
+        default=None,
+        help="Path to a JSON file in which to cache the tags that were found."
+        " Repositories whose collection versions can all be found in the cache"
+        " are not queried again until their entry is older than"
+        " --tag-cache-ttl. Tags that were deleted upstream are not detected"
+        " before that. The file is created if it does not exist.",
+    )
+    validate_tags.add_argument(
+        "--tag-cache-ttl",
+        type=int,
+        default=DEFAULT_TAG_CACHE_TTL,
+        help="Number of seconds after which a repository's entry in"
+        f" --tag-cache is no longer used. The default is {DEFAULT_TAG_CACHE_TTL}.",
+    )
 
     validate_tags_file = subparsers.add_parser(
         "validate-tags-file",
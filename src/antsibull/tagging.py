@@ -10,13 +10,21 @@ Validate that collections tag their releases in their respective git repositorie
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import dataclasses
+import functools
+import hashlib
+import json
 import os
 import re
+import subprocess
 import sys
-from collections.abc import AsyncGenerator, Collection
+import tempfile
+import time
+from collections.abc import AsyncGenerator, Collection, Iterable
+from collections.abc import Set as AbstractSet
 from typing import TYPE_CHECKING, TextIO, TypedDict
 
-import asyncio_pool  # type: ignore[import]
 from antsibull_core import app_context
 from antsibull_core.dependency_files import DepsFile
 from antsibull_core.logging import log
@@ -29,8 +37,16 @@ from antsibull_fileutils.yaml import load_yaml_file, store_yaml_file
 if TYPE_CHECKING:
     from typing_extensions import NotRequired
 
-TAG_MATCHER: re.Pattern[str] = re.compile(r"^.*refs/tags/(.*)$")
-TAG_VERSION_REGEX: re.Pattern[str] = re.compile(r"^v?(.*)$")
+TAG_REF_MARKER = b"\trefs/tags/"
+GIT_ENV: dict[str, str] = {
+    # This makes it so git doesn't ask for a password when a repository
+    # is inaccessible.
+    "GIT_TERMINAL_PROMPT": "0",
+    # Ask servers for protocol v2 so that they only advertise the refs we request.
+    "GIT_PROTOCOL": "version=2",
+}
+DEFAULT_MIRROR_REFRESH_TTL = 3600
+DEFAULT_TAG_CACHE_TTL = 3600
 mlog = log.fields(mod=__name__)
 
 
@@ -60,16 +76,83 @@ def validate_tags_command() -> int:
     """
     app_ctx = app_context.app_ctx.get()
     ignores = _get_ignores(app_ctx.extra["ignore"], app_ctx.extra["ignores_file"])
+    tag_cache = _load_tag_cache(app_ctx.extra["tag_cache"])
     tag_data = asyncio.run(
-        get_collections_tags(app_ctx.extra["data_dir"], app_ctx.extra["deps_file"])
+        get_collections_tags(
+            app_ctx.extra["data_dir"],
+            app_ctx.extra["deps_file"],
+            mirror_dir=app_ctx.extra["mirror_dir"],
+            mirror_refresh_ttl=app_ctx.extra["mirror_refresh_ttl"],
+            tag_cache=tag_cache,
+            tag_cache_ttl=app_ctx.extra["tag_cache_ttl"],
+        )
     )
     if app_ctx.extra["output"]:
         store_yaml_file(app_ctx.extra["output"], tag_data)
-    return _print_validation_errors(
+    ret = _print_validation_errors(
         tag_data,
         ignores,
         app_ctx.extra["error_on_useless_ignores"],
     )
+    if tag_cache is not None:
+        try:
+            _store_tag_cache(app_ctx.extra["tag_cache"], tag_cache)
+        except OSError as err:
+            mlog.fields(func="validate_tags_command", err=err).warning(
+                f"Failed to write tag cache {app_ctx.extra['tag_cache']}"
+            )
+    return ret
+
+
+def _load_tag_cache(path: str | None) -> dict[str, TagCacheEntry] | None:
+    flog = mlog.fields(func="_load_tag_cache")
+    if not path:
+        return None
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding="utf-8") as fp:
+            data = json.load(fp)
+    except ValueError as err:
+        flog.fields(err=err).warning(f"Ignoring invalid tag cache {path}")
+        return {}
+    if not _is_tag_cache(data):
+        flog.warning(f"Ignoring tag cache {path} with unexpected structure")
+        return {}
+    return data
+
+
+def _is_tag_cache(data: object) -> bool:
+    if not isinstance(data, dict):
+        return False
+    for repository, entry in data.items():
+        if not isinstance(repository, str) or not isinstance(entry, dict):
+            return False
+        fetched = entry.get("fetched")
+        tags = entry.get("tags")
+        if isinstance(fetched, bool) or not isinstance(fetched, (int, float)):
+            return False
+        if not isinstance(tags, list) or not all(isinstance(t, str) for t in tags):
+            return False
+    return True
+
+
+def _store_tag_cache(path: str, tag_cache: dict[str, TagCacheEntry]) -> None:
+    # Write to a temporary file in the same directory and move it into place,
+    # so that an interrupted run does not leave a truncated cache behind
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=f".{os.path.basename(path)}.",
+        suffix=".tmp",
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            json.dump(tag_cache, fp, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
 
 
 def _print_validation_errors(
@@ -91,11 +174,8 @@ def _print_validation_errors(
 def _get_ignores(ignores: Collection[str], ignore_fp: TextIO | None) -> set[str]:
     ignores = set(ignores)
     if ignore_fp:
-        ignores.update(
-            line.strip()
-            for line in ignore_fp
-            if line.strip() and not line.startswith("#")
-        )
+        lines = map(str.strip, ignore_fp.read().splitlines())
+        ignores.update(line for line in lines if line and not line.startswith("#"))
     return ignores
 
 
@@ -117,27 +197,37 @@ def validate_tags(
     :param ignores: A list of collection names for which to ignore errors
     :param error_on_useless_ignores: Whether to error for useless ignores
     """
-    errors = []
-    ignore_set = set(ignores)
-    for name, data in tag_data.items():
-        version = data["version"]
-        if name in ignore_set:
-            ignore_set.remove(name)
-            if data["repository"] and data["tag"] and error_on_useless_ignores:
-                errors.append(
-                    f"useless ignore {name!r}: {name} {version} is properly tagged"
-                )
-        elif not data["repository"]:
-            errors.append(
-                f"{name}'s repository is not specified at all in collection-meta.yaml"
-            )
-        elif not data["tag"]:
-            errors.append(f'{name} {version} is not tagged in {data["repository"]}')
-    if ignore_set and error_on_useless_ignores:
-        for name in ignore_set:
-            errors.append(
-                f"invalid ignore {name!r}: {name} does not match any collection"
-            )
+    errors: list[str] = []
+    # _get_ignores() already returns a set. Only copy other collections.
+    ignore_set = ignores if isinstance(ignores, AbstractSet) else set(ignores)
+    names = set(tag_data)
+    checked = names - ignore_set
+    missing_repo = {name for name in checked if not tag_data[name]["repository"]}
+    untagged = {name for name in checked - missing_repo if not tag_data[name]["tag"]}
+    errors.extend(
+        f"{name}'s repository is not specified at all in collection-meta.yaml"
+        for name in sorted(missing_repo)
+    )
+    errors.extend(
+        f'{name} {tag_data[name]["version"]} is not tagged'
+        f' in {tag_data[name]["repository"]}'
+        for name in sorted(untagged)
+    )
+    if error_on_useless_ignores:
+        useless_ignores = {
+            name
+            for name in names & ignore_set
+            if tag_data[name]["repository"] and tag_data[name]["tag"]
+        }
+        errors.extend(
+            f"useless ignore {name!r}: {name} {tag_data[name]['version']}"
+            " is properly tagged"
+            for name in sorted(useless_ignores)
+        )
+        errors.extend(
+            f"invalid ignore {name!r}: {name} does not match any collection"
+            for name in sorted(ignore_set - names)
+        )
     return errors
 
 
@@ -148,8 +238,18 @@ class CollectionTagData(TypedDict):
     collection_directory: NotRequired[str]
 
 
+class TagCacheEntry(TypedDict):
+    fetched: float
+    tags: list[str]
+
+
 async def get_collections_tags(
-    data_dir: str, deps_filename: str
+    data_dir: str,
+    deps_filename: str,
+    mirror_dir: str | None = None,
+    mirror_refresh_ttl: int = DEFAULT_MIRROR_REFRESH_TTL,
+    tag_cache: dict[str, TagCacheEntry] | None = None,
+    tag_cache_ttl: int = DEFAULT_TAG_CACHE_TTL,
 ) -> dict[str, CollectionTagData]:
     """
     Iterate over the collections in a CollectionsMetadata file,
@@ -157,25 +257,142 @@ async def get_collections_tags(
     of collection names mapped to dictionaries containing
     each collection's 'version' and 'repository' from a DepsFile
     and the 'tag' that matches.
-    """
-    lib_ctx = app_context.lib_ctx.get()
 
+    :param mirror_dir: If given, keep bare clones of the collections'
+        repositories in this directory and read the tags from them instead
+        of querying the remotes with ``git ls-remote``.
+    :param mirror_refresh_ttl: Number of seconds after which an existing
+        mirror is fetched again.
+    :param tag_cache: If given, a mapping of repository URLs to the tags
+        that were found and the time they were fetched. Repositories whose
+        collections can all be resolved from an entry that is younger than
+        tag_cache_ttl are not queried. It is updated in place with the
+        tags that were found.
+    :param tag_cache_ttl: Number of seconds after which a tag cache entry
+        is no longer used. Tags deleted upstream are only noticed once the
+        entry has expired.
+    """
     deps_filename = os.path.join(data_dir, deps_filename)
-    deps_data = DepsFile(deps_filename).parse()
-    meta_data = CollectionsMetadata.load_from(data_dir)
-
-    async with asyncio_pool.AioPool(size=lib_ctx.thread_max) as pool:
-        collection_tags = {}
-        for name, data in meta_data.collections.items():
-            collection_tags[name] = pool.spawn_n(
-                _get_collection_tags(deps_data.deps[name], data, name)
+    # Parse both YAML files in parallel without blocking the event loop
+    deps_data, meta_data = await asyncio.gather(
+        asyncio.to_thread(DepsFile(deps_filename).parse),
+        asyncio.to_thread(CollectionsMetadata.load_from, data_dir),
+    )
+
+    # Each task spawns a git subprocess, so bound the fan-out by the number
+    # of CPUs rather than lib_ctx.thread_max, which is sized for HTTP requests.
+    sem = asyncio.Semaphore(_get_git_max())
+    mirror = _TagMirror(mirror_dir, mirror_refresh_ttl) if mirror_dir else None
+    # Without a tag cache, write into a throwaway one that always starts empty
+    cache = tag_cache if tag_cache is not None else {}
+
+    # Several collections can share a repository, so only list its tags once
+    repo_to_names: dict[str, list[str]] = {}
+    for name, data in meta_data.collections.items():
+        if data.repository:
+            repo_to_names.setdefault(data.repository, []).append(name)
+
+    async def _bounded(repository: str) -> _RepositoryTags:
+        collections = [
+            (deps_data.deps[name], meta_data.collections[name])
+            for name in repo_to_names[repository]
+        ]
+        entry = _get_tag_cache_entry(cache, repository, tag_cache_ttl)
+        if entry:
+            cached = _RepositoryTags(entry["tags"])
+            if _has_all_tags(cached, collections):
+                return cached
+        patterns = _get_tag_patterns(collections)
+        async with sem:
+            tags = [tag async for tag in _get_tags(repository, mirror, patterns)]
+        cache[repository] = _new_tag_cache_entry(entry, tags)
+        return _RepositoryTags(tags)
+
+    # asyncio.TaskGroup needs Python 3.11, so cancel the remaining tasks
+    # by hand when one of them fails. Queued tasks never start git.
+    tasks = [asyncio.create_task(_bounded(repo)) for repo in repo_to_names]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    repo_to_tags = dict(zip(repo_to_names, results))
+
+    return {
+        name: _get_collection_tags(
+            deps_data.deps[name],
+            data,
+            name,
+            repo_to_tags,
+        )
+        for name, data in meta_data.collections.items()
+    }
+
+
+def _get_tag_cache_entry(
+    tag_cache: dict[str, TagCacheEntry], repository: str, ttl: int
+) -> TagCacheEntry | None:
+    entry = tag_cache.get(repository)
+    if entry is None or time.time() - entry["fetched"] >= ttl:
+        return None
+    return entry
+
+
+def _new_tag_cache_entry(
+    entry: TagCacheEntry | None, tags: Iterable[str]
+) -> TagCacheEntry:
+    if entry is None:
+        return {"fetched": time.time(), "tags": sorted(tags)}
+    # Keep the fetch time of the entry that is added to, so that its tags
+    # expire no later than they would have otherwise
+    return {"fetched": entry["fetched"], "tags": sorted({*entry["tags"], *tags})}
+
+
+def _get_git_max() -> int:
+    return min(32, max(4, (os.cpu_count() or 2) * 2))
+
+
+def _has_all_tags(
+    repo_tags: _RepositoryTags, collections: Iterable[tuple[str, CollectionMetadata]]
+) -> bool:
+    for version, meta_data in collections:
+        try:
+            regex = (
+                _compile_tag_re(meta_data.tag_version_regex)
+                if meta_data.tag_version_regex
+                else None
             )
-        collection_tags = {name: await data for name, data in collection_tags.items()}
-        return collection_tags
+        except re.error:
+            return False
+        if repo_tags.find(version, regex) is None:
+            return False
+    return True
+
+
+def _get_tag_patterns(
+    collections: Iterable[tuple[str, CollectionMetadata]],
+) -> list[str]:
+    """
+    Return the tag refs that can possibly match the collections' versions.
+    Without a custom tag_version_regex, a version can only be tagged as
+    '<version>' or 'v<version>', so there is no need to list every tag.
+    An empty list means that all tags are needed.
+    """
+    patterns: list[str] = []
+    for version, meta_data in collections:
+        if meta_data.tag_version_regex:
+            return []
+        patterns.extend((f"refs/tags/{version}", f"refs/tags/v{version}"))
+    return patterns
 
 
-async def _get_collection_tags(
-    version: str, meta_data: CollectionMetadata, name: str
+def _get_collection_tags(
+    version: str,
+    meta_data: CollectionMetadata,
+    name: str,
+    repo_to_tags: dict[str, _RepositoryTags],
 ) -> CollectionTagData:
     flog = mlog.fields(func="_get_collection_tags")
     repository = meta_data.repository
@@ -192,56 +409,187 @@ async def _get_collection_tags(
     tag_version_regex: re.Pattern[str] | None = None
     if meta_data.tag_version_regex:
         try:
-            tag_version_regex = re.compile(meta_data.tag_version_regex)
+            tag_version_regex = _compile_tag_re(meta_data.tag_version_regex)
         except re.error as err:
             flog.fields(err=err, collection=name).error(
-                f"{tag_version_regex} is an invalid regex"
+                f"{meta_data.tag_version_regex} is an invalid regex"
             )
             return data
-    async for tag in _get_tags(repository):
-        if _normalize_tag(tag, tag_version_regex) == version:
-            data["tag"] = tag
-            break
+    data["tag"] = repo_to_tags[repository].find(version, tag_version_regex)
     return data
 
 
-async def _get_tags(repository) -> AsyncGenerator[str, None]:
-    flog = mlog.fields(func="_get_tags")
-    args = (
-        "git",
-        "ls-remote",
-        "--refs",
-        "--tags",
-        repository,
-    )
-    flog.debug(f"Running {args}")
-    proc = await asyncio.create_subprocess_exec(
-        *args,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-        # This makes it so git doesn't ask for a password when a repository
-        # is inaccessible.
-        env={"GIT_TERMINAL_PROMPT": "0"},
+@dataclasses.dataclass
+class _RepositoryTags:
+    """
+    The tags of a repository, indexed by normalized version on demand
+    """
+
+    tags: list[str]
+    _indexes: dict[re.Pattern[str] | None, dict[str, str]] = dataclasses.field(
+        default_factory=dict, init=False, repr=False
     )
-    stdout, stderr = await proc.communicate()
-    flog.fields(stderr=stderr, returncode=proc.returncode).debug("Ran git ls-remote")
-    if proc.returncode != 0:
+
+    def find(self, version: str, regex: re.Pattern[str] | None) -> str | None:
+        if regex not in self._indexes:
+            self._indexes[regex] = _index_tags(self.tags, regex)
+        return self._indexes[regex].get(version)
+
+
+async def _get_tags(
+    repository: str,
+    mirror: _TagMirror | None = None,
+    patterns: Collection[str] = (),
+) -> AsyncGenerator[str, None]:
+    """
+    Yield the tags of a repository.
+    If patterns are given, only tags matching them are listed.
+    """
+    flog = mlog.fields(func="_get_tags")
+    if mirror:
+        path = await mirror.update(repository)
+        if path is None:
+            return
+        args: tuple[str, ...] = (
+            "-C",
+            path,
+            "for-each-ref",
+            "--format=%(refname:strip=2)",
+            *(patterns or ("refs/tags/",)),
+        )
+    else:
+        # Protocol v2 lets git send a ref-prefix so the server only advertises
+        # refs/tags/ instead of every branch and pull request ref.
+        # git matches the patterns itself, so we only parse the matching lines.
+        args = (
+            "-c",
+            "protocol.version=2",
+            "ls-remote",
+            "--refs",
+            "--tags",
+            repository,
+            *patterns,
+        )
+    stdout = await _run_git(*args)
+    if stdout is None:
         flog.error(f"Failed to fetch tags for {repository}")
         return
-    tags: list[str] = stdout.decode("utf-8").splitlines()
-    if not tags:
+    lines = stdout.splitlines()
+    if not lines and not patterns:
         flog.warning(f"{repository} does not have any tags")
         return
-    for tag in tags:
-        match = TAG_MATCHER.match(tag)
-        if match:
-            yield match.group(1)
+    for line in lines:
+        if mirror:
+            yield line.decode("utf-8")
+            continue
+        # git ls-remote prints '<sha>\trefs/tags/<name>' for each tag.
+        # Only decode the tag name instead of the whole line.
+        idx = line.find(TAG_REF_MARKER)
+        if idx != -1:
+            start = idx + len(TAG_REF_MARKER)
+            yield line[start:].decode("utf-8")
         else:
-            flog.debug(f"git ls-remote output line skipped: {tag}")
+            flog.debug(f"git ls-remote output line skipped: {line!r}")
+
+
+@dataclasses.dataclass
+class _TagMirror:
+    """
+    Local bare clones of collection repositories that are used to list tags
+    without a network round trip for each run
+    """
 
+    directory: str
+    refresh_ttl: int = DEFAULT_MIRROR_REFRESH_TTL
+    _locks: dict[str, asyncio.Lock] = dataclasses.field(
+        default_factory=dict, init=False, repr=False
+    )
+
+    def get_path(self, repository: str) -> str:
+        slug = repository.split("://", 1)[-1].removesuffix(".git")
+        slug = re.sub(r"[^A-Za-z0-9._-]+", "_", slug).strip("_")
+        # The slug is lossy, so add a hash of the URL to keep names unique
+        digest = hashlib.sha256(repository.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.directory, f"{slug}-{digest}.git")
+
+    async def update(self, repository: str) -> str | None:
+        """
+        Create or refresh the mirror for a repository.
+        Return its path or None if the mirror is not available.
+        """
+        flog = mlog.fields(func="_TagMirror.update", repository=repository)
+        path = self.get_path(repository)
+        async with self._locks.setdefault(path, asyncio.Lock()):
+            if not os.path.isdir(path):
+                stdout = await _run_git(
+                    "clone", "--bare", "--filter=blob:none", repository, path
+                )
+                if stdout is None:
+                    flog.error(f"Failed to clone {repository} into {path}")
+                    return None
+            elif time.time() - os.stat(path).st_mtime >= self.refresh_ttl:
+                # Tags fetched with --tags are exempt from --prune, so use an
+                # explicit refspec to drop tags that were deleted upstream.
+                # Fetching from origin keeps the promisor remote's filter.
+                stdout = await _run_git(
+                    "-C",
+                    path,
+                    "fetch",
+                    "--prune",
+                    "origin",
+                    "+refs/tags/*:refs/tags/*",
+                )
+                if stdout is None:
+                    flog.warning(f"Failed to fetch {repository}. Using stale {path}")
+                    return path
+            else:
+                return path
+            os.utime(path)
+        return path
+
+
+async def _run_git(*args: str) -> bytes | None:
+    """
+    Run a git subcommand and return its stdout, or None if it failed.
+    """
+    flog = mlog.fields(func="_run_git")
+    args = ("git", *args)
+    flog.debug(f"Running {args}")
+    # Spawn and wait for git in a worker thread. This way, starting many
+    # processes is not serialized on the event loop's child watcher.
+    proc = await asyncio.to_thread(
+        subprocess.run, args, capture_output=True, env=GIT_ENV, check=False
+    )
+    flog.fields(stderr=proc.stderr, returncode=proc.returncode).debug(f"Ran {args}")
+    if proc.returncode != 0:
+        return None
+    return proc.stdout
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_tag_re(pattern: str) -> re.Pattern[str]:
+    return re.compile(pattern)
 
-def _normalize_tag(tag: str, regex: re.Pattern[str] | None) -> str | None:
-    regex = regex or TAG_VERSION_REGEX
+
+def _index_tags(tags: Iterable[str], regex: re.Pattern[str] | None) -> dict[str, str]:
+    """
+    Map normalized versions to tags.
+    If several tags normalize to the same version, the first one wins.
+    """
+    by_version: dict[str, str] = {}
+    for tag in tags:
+        by_version.setdefault(_normalize_tag(tag, regex), tag)
+    return by_version
+
+
+def _normalize_tag(tag: str, regex: re.Pattern[str] | None) -> str:
+    """
+    Return the version a tag refers to. Without a custom regex, this strips
+    an optional leading 'v'. A tag that does not match the regex is returned
+    as is.
+    """
+    if regex is None:
+        return tag[1:] if tag.startswith("v") else tag
     if match := regex.match(tag):
         return match.group(1)
     return tag
@@ -3,13 +3,54 @@
 # GNU General Public License v3.0+ (see LICENSES/GPL-3.0-or-later.txt or
 # https://www.gnu.org/licenses/gpl-3.0.txt)
 
+from __future__ import annotations
+
+import json
+import os
+import re
+import subprocess
 from pathlib import Path
 from unittest.mock import patch
 
 import pytest
 from antsibull_core.yaml import load_yaml_file
 
+import antsibull.tagging
 from antsibull.cli.antsibull_build import run
+from antsibull.tagging import (
+    CollectionTagData,
+    TagCacheEntry,
+    _get_tags,
+    _load_tag_cache,
+    _normalize_tag,
+    _store_tag_cache,
+    _TagMirror,
+    get_collections_tags,
+    validate_tags,
+)
+
+GIT_COMMIT_ENV = {
+    "GIT_AUTHOR_NAME": "Test",
+    "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "Test",
+    "GIT_COMMITTER_EMAIL": "test@example.com",
+}
+
+
+@pytest.fixture
+def tagged_repo(tmp_path: Path) -> Path:
+    repo = tmp_path / "repo"
+    env = {**os.environ, **GIT_COMMIT_ENV}
+
+    def git(*args: str) -> None:
+        subprocess.run(["git", "-C", str(repo), *args], check=True, env=env)
+
+    repo.mkdir()
+    git("init", "-q")
+    git("commit", "-q", "--allow-empty", "-m", "Initial commit")
+    git("tag", "v1.0.0")
+    git("tag", "-a", "-m", "2.0.0", "2.0.0")
+    return repo
 
 
 @pytest.mark.parametrize(
@@ -178,6 +219,21 @@ def test_validate_tags_file(
             1,
             id="mixed",
         ),
+        pytest.param(
+            [],
+            [
+                "# A comment",
+                "  # An indented comment",
+                "",
+                "  cisco.nso  ",
+                "hpe.nimble",
+                "inspur.sm",
+                "mellanox.onyx",
+            ],
+            [],
+            0,
+            id="comments",
+        ),
     ],
 )
 def test_validate_tags_file_ignore_file(
@@ -228,3 +284,293 @@ def test_validate_tags(test_data_path: Path, tmp_path: Path):
     assert ran == 0
     output_data = load_yaml_file(output_data_path)
     assert expected_data == output_data
+
+
+def test_validate_tags_tag_cache(test_data_path: Path, tmp_path: Path):
+    tag_data = load_yaml_file(test_data_path / "ansible-7.4.0-tags.yaml")
+    cache_path = tmp_path / "tag-cache.json"
+    # A truncated cache is ignored instead of crashing the command
+    cache_path.write_text('{"https://example.com/repo": {"fetched"')
+    entry: TagCacheEntry = {"fetched": 1.0, "tags": ["1.0.0"]}
+    seen: list[dict[str, TagCacheEntry]] = []
+
+    def _get_collections_tags(*args, tag_cache, **kwargs):
+        seen.append(dict(tag_cache))
+        tag_cache["https://example.com/repo"] = entry
+        return tag_data
+
+    args = [
+        "antsibull-build",
+        "validate-tags",
+        f"--data-dir={test_data_path}",
+        f"--ignores-file={test_data_path / 'validate-tags-ignores'}",
+        f"--tag-cache={cache_path}",
+        "7.4.0",
+    ]
+    with patch(
+        "antsibull.tagging.get_collections_tags", side_effect=_get_collections_tags
+    ):
+        assert run(args) == 0
+        assert run(args) == 0
+    assert seen == [{}, {"https://example.com/repo": entry}]
+    assert json.loads(cache_path.read_text()) == {"https://example.com/repo": entry}
+    assert os.listdir(tmp_path) == ["tag-cache.json"]
+
+
+def test_validate_tags_tag_cache_unwritable(test_data_path: Path, tmp_path: Path):
+    tag_data = load_yaml_file(test_data_path / "ansible-7.4.0-tags.yaml")
+    output = tmp_path / "tags.yaml"
+    args = [
+        "antsibull-build",
+        "validate-tags",
+        f"--data-dir={test_data_path}",
+        f"--ignores-file={test_data_path / 'validate-tags-ignores'}",
+        f"--tag-cache={tmp_path / 'missing' / 'tag-cache.json'}",
+        f"--output={output}",
+        "7.4.0",
+    ]
+    # Failing to write the cache does not discard the results
+    with patch("antsibull.tagging.get_collections_tags", return_value=tag_data):
+        assert run(args) == 0
+    assert load_yaml_file(output) == tag_data
+    assert os.listdir(tmp_path) == ["tags.yaml"]
+
+
+def test_tag_cache_round_trip(tmp_path: Path) -> None:
+    path = tmp_path / "tag-cache.json"
+    assert _load_tag_cache(None) is None
+    assert _load_tag_cache(str(path)) == {}
+    tag_cache: dict[str, TagCacheEntry] = {
+        "https://example.com/a": {"fetched": 1.5, "tags": ["1.0.0", "v2.0.0"]},
+        "https://example.com/b": {"fetched": 2, "tags": []},
+    }
+    _store_tag_cache(str(path), tag_cache)
+    assert _load_tag_cache(str(path)) == tag_cache
+    # Storing again replaces the file
+    tag_cache.pop("https://example.com/b")
+    _store_tag_cache(str(path), tag_cache)
+    assert _load_tag_cache(str(path)) == tag_cache
+    assert os.listdir(tmp_path) == ["tag-cache.json"]
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        pytest.param('{"https://example.com/a": ', id="truncated"),
+        pytest.param('["https://example.com/a"]', id="not-a-dict"),
+        pytest.param('{"https://example.com/a": ["1.0.0"]}', id="old-format"),
+        pytest.param(
+            '{"https://example.com/a": {"fetched": "now", "tags": []}}',
+            id="bad-fetched",
+        ),
+        pytest.param(
+            '{"https://example.com/a": {"fetched": 1, "tags": [1]}}',
+            id="bad-tags",
+        ),
+    ],
+)
+def test_load_tag_cache_invalid(tmp_path: Path, contents: str) -> None:
+    path = tmp_path / "tag-cache.json"
+    path.write_text(contents)
+    assert _load_tag_cache(str(path)) == {}
+
+
+@pytest.mark.asyncio
+async def test_get_tags(tagged_repo: Path) -> None:
+    tags = [tag async for tag in _get_tags(str(tagged_repo))]
+    assert sorted(tags) == ["2.0.0", "v1.0.0"]
+    patterns = ["refs/tags/1.0.0", "refs/tags/v1.0.0"]
+    tags = [tag async for tag in _get_tags(str(tagged_repo), None, patterns)]
+    assert tags == ["v1.0.0"]
+
+
+@pytest.mark.asyncio
+async def test_get_tags_mirror(tagged_repo: Path, tmp_path: Path) -> None:
+    # --filter is ignored for plain local paths, so go through file://
+    subprocess.run(
+        ["git", "-C", str(tagged_repo), "config", "uploadpack.allowFilter", "true"],
+        check=True,
+    )
+    repository = f"file://{tagged_repo}"
+    mirror = _TagMirror(str(tmp_path / "mirrors"))
+    tags = [tag async for tag in _get_tags(repository, mirror)]
+    assert sorted(tags) == ["2.0.0", "v1.0.0"]
+    path = mirror.get_path(repository)
+    assert os.path.isdir(path)
+    promisor = subprocess.run(
+        ["git", "-C", path, "config", "remote.origin.promisor"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    assert promisor.stdout.strip() == "true"
+    patterns = ["refs/tags/1.0.0", "refs/tags/v1.0.0"]
+    tags = [tag async for tag in _get_tags(repository, mirror, patterns)]
+    assert tags == ["v1.0.0"]
+
+    subprocess.run(["git", "-C", str(tagged_repo), "tag", "3.0.0"], check=True)
+    subprocess.run(["git", "-C", str(tagged_repo), "tag", "-d", "v1.0.0"], check=True)
+    tags = [tag async for tag in _get_tags(repository, mirror)]
+    assert sorted(tags) == ["2.0.0", "v1.0.0"]
+    mirror.refresh_ttl = 0
+    tags = [tag async for tag in _get_tags(repository, mirror)]
+    assert sorted(tags) == ["2.0.0", "3.0.0"]
+
+
+def test_tag_mirror_get_path_unique(tmp_path: Path) -> None:
+    mirror = _TagMirror(str(tmp_path))
+    assert mirror.get_path("https://github.com/foo/bar_baz") != mirror.get_path(
+        "https://github.com/foo_bar/baz"
+    )
+
+
+@pytest.mark.parametrize(
+    "tag, regex, expected",
+    [
+        pytest.param("v1.0.0", None, "1.0.0", id="v-prefix"),
+        pytest.param("1.0.0", None, "1.0.0", id="no-prefix"),
+        pytest.param("release-1.0.0", r"^release-(.*)$", "1.0.0", id="regex"),
+        pytest.param("v1.0.0", r"^release-(.*)$", "v1.0.0", id="regex-no-match"),
+    ],
+)
+def test_normalize_tag(tag: str, regex: str | None, expected: str) -> None:
+    pattern = re.compile(regex) if regex else None
+    assert _normalize_tag(tag, pattern) == expected
+
+
+@pytest.fixture
+def tags_data_dir(tagged_repo: Path, tmp_path: Path) -> Path:
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    (data_dir / "ansible-1.0.0.deps").write_text(
+        "_ansible_version: 1.0.0\n"
+        "_ansible_core_version: 2.16.0\n"
+        "foo.bar: 1.0.0\n"
+        "foo.baz: 2.0.0\n"
+        "foo.untagged: 3.0.0\n"
+        "other.custom: 2.0.0\n"
+    )
+    (data_dir / "collection-meta.yaml").write_text(
+        "collections:\n"
+        "  foo.bar:\n"
+        "    maintainers: []\n"
+        f"    repository: {tagged_repo}\n"
+        "  foo.baz:\n"
+        "    maintainers: []\n"
+        f"    repository: {tagged_repo}\n"
+        "    collection-directory: ./baz\n"
+        "  foo.untagged:\n"
+        "    maintainers: []\n"
+        f"    repository: {tagged_repo}\n"
+        "  other.custom:\n"
+        "    maintainers: []\n"
+        f"    repository: file://{tagged_repo}\n"
+        "    tag_version_regex: ^(.*)$\n"
+    )
+    return data_dir
+
+
+def _record_get_tags_calls(monkeypatch: pytest.MonkeyPatch) -> dict[str, list[str]]:
+    calls: dict[str, list[str]] = {}
+    orig_get_tags = antsibull.tagging._get_tags
+
+    def _get_tags_wrapper(repository, mirror, patterns):
+        calls[repository] = patterns
+        return orig_get_tags(repository, mirror, patterns)
+
+    monkeypatch.setattr(antsibull.tagging, "_get_tags", _get_tags_wrapper)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_get_collections_tags(
+    tagged_repo: Path, tags_data_dir: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    calls = _record_get_tags_calls(monkeypatch)
+    tag_data = await get_collections_tags(str(tags_data_dir), "ansible-1.0.0.deps")
+    assert tag_data == {
+        "foo.bar": {
+            "version": "1.0.0",
+            "repository": str(tagged_repo),
+            "tag": "v1.0.0",
+        },
+        "foo.baz": {
+            "version": "2.0.0",
+            "repository": str(tagged_repo),
+            "tag": "2.0.0",
+            "collection_directory": "./baz",
+        },
+        "foo.untagged": {
+            "version": "3.0.0",
+            "repository": str(tagged_repo),
+            "tag": None,
+        },
+        "other.custom": {
+            "version": "2.0.0",
+            "repository": f"file://{tagged_repo}",
+            "tag": "2.0.0",
+        },
+    }
+    assert calls == {
+        str(tagged_repo): [
+            "refs/tags/1.0.0",
+            "refs/tags/v1.0.0",
+            "refs/tags/2.0.0",
+            "refs/tags/v2.0.0",
+            "refs/tags/3.0.0",
+            "refs/tags/v3.0.0",
+        ],
+        f"file://{tagged_repo}": [],
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_collections_tags_cache(
+    tagged_repo: Path, tags_data_dir: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    tag_cache: dict[str, TagCacheEntry] = {}
+    await get_collections_tags(
+        str(tags_data_dir), "ansible-1.0.0.deps", tag_cache=tag_cache
+    )
+    assert {repo: entry["tags"] for repo, entry in tag_cache.items()} == {
+        str(tagged_repo): ["2.0.0", "v1.0.0"],
+        f"file://{tagged_repo}": ["2.0.0", "v1.0.0"],
+    }
+
+    # foo.untagged still is not tagged, so only its repository is queried again
+    calls = _record_get_tags_calls(monkeypatch)
+    tag_data = await get_collections_tags(
+        str(tags_data_dir), "ansible-1.0.0.deps", tag_cache=tag_cache
+    )
+    assert list(calls) == [str(tagged_repo)]
+    assert tag_data["other.custom"]["tag"] == "2.0.0"
+
+    # Expired entries are not used, so tags deleted upstream are noticed
+    subprocess.run(["git", "-C", str(tagged_repo), "tag", "-d", "2.0.0"], check=True)
+    calls.clear()
+    tag_data = await get_collections_tags(
+        str(tags_data_dir), "ansible-1.0.0.deps", tag_cache=tag_cache, tag_cache_ttl=0
+    )
+    assert set(calls) == {f"file://{tagged_repo}", str(tagged_repo)}
+    assert tag_data["other.custom"]["tag"] is None
+    assert tag_cache[f"file://{tagged_repo}"]["tags"] == ["v1.0.0"]
+
+
+def test_validate_tags_errors() -> None:
+    tag_data: dict[str, CollectionTagData] = {
+        "foo.tagged": {"version": "1.0.0", "repository": "https://a", "tag": "1.0.0"},
+        "foo.untagged": {"version": "1.0.0", "repository": "https://b", "tag": None},
+        "foo.norepo": {"version": "1.0.0", "repository": None, "tag": None},
+        "foo.ignored": {"version": "1.0.0", "repository": None, "tag": None},
+    }
+    assert validate_tags(tag_data, {"foo.ignored", "foo.tagged", "bar.baz"}) == [
+        "foo.norepo's repository is not specified at all in collection-meta.yaml",
+        "foo.untagged 1.0.0 is not tagged in https://b",
+        "useless ignore 'foo.tagged': foo.tagged 1.0.0 is properly tagged",
+        "invalid ignore 'bar.baz': bar.baz does not match any collection",
+    ]
+    assert validate_tags(tag_data, ["foo.tagged", "bar.baz"], False) == [
+        "foo.ignored's repository is not specified at all in collection-meta.yaml",
+        "foo.norepo's repository is not specified at all in collection-meta.yaml",
+        "foo.untagged 1.0.0 is not tagged in https://b",
+    ]